@@ -1,56 +1,330 @@
 import streamlit as st
 import os
-import requests
+import httpx
 from supabase import create_client #, Client # Client annotation can be imported if needed for type hinting
+from postgrest.types import ReturnMethod
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import asyncio
+import threading
+import functools
+import collections
 import time
-import json # For pretty printing JSON responses
+import orjson # Fast JSON encoding for request bodies and pretty printing
+from typing import NamedTuple, Optional
 
 # --- Environment and Configuration ---
 load_dotenv()
 
 SENSAY_API_BASE_URL = "https://api.sensay.io/v1"
+SENSAY_HTTP_METHODS = frozenset({"GET", "POST", "PUT", "DELETE"}) # Methods make_sensay_request accepts (upper-case)
 DEFAULT_SENSAY_API_VERSION = "2025-03-25"
 DEFAULT_SUPABASE_TABLE_NAME = "slack_messages_for_sensay"
 DEFAULT_TEST_CHAT_USER_ID = "streamlit_default_tester"
+TRAINING_CONCURRENCY = 8 # Sensay requests per training stage (KB entry create / text upload) in flight at once
+SUPABASE_UPDATE_BATCH_SIZE = 100 # Message IDs marked as processed per Supabase UPDATE
+SUPABASE_PAGE_SIZE = 1000 # Unprocessed messages fetched per Supabase request while training
+TRAINING_LOG_TAIL_LINES = 10 # Log lines shown while training is running
+TRAINING_LOG_FLUSH_EVERY = 10 # Redraw the running log at most every N messages...
+TRAINING_LOG_FLUSH_SECONDS = 0.5 # ...or once this much time has passed since the last redraw
+CHAT_HISTORY_MAX_MESSAGES = 200 # Older chat messages per replica are dropped beyond this
+SENSAY_USER_CHECK_TIMEOUT = 30 # Seconds a rerun waits on a Sensay user check before reporting an error
+
+# --- Replica View ---
+
+class ReplicaView(NamedTuple):
+    # Replica fields the UI renders, pulled out of the API payload once per fetch
+    uuid: str
+    name: str
+    slug: str
+    owner_id: Optional[str] # ownerID, i.e. the Slack user whose messages train this replica
+    llm_model: str
+    greeting: Optional[str]
+    raw: dict # Original payload, for the raw JSON view
+
+    @classmethod
+    def from_api(cls, replica):
+        return cls(
+            uuid=replica.get("uuid", "N/A"),
+            name=replica.get("name", "N/A"),
+            slug=replica.get("slug", "N/A"),
+            owner_id=replica.get("ownerID"),
+            llm_model=(replica.get("llm") or {}).get("model", "N/A"),
+            greeting=replica.get("greeting"),
+            raw=replica,
+        )
 
 # --- Helper Functions for API Calls ---
 
-def make_sensay_request(method, endpoint, sensay_org_secret, sensay_api_version, json_data=None, params=None, user_id=None):
+@st.cache_resource
+def _supabase(url, key):
+    # Shared across reruns for the same credentials, so the underlying HTTP connection pool is reused
+    return create_client(url, key)
+
+@st.cache_resource
+def _user_check_pool():
+    # Survives reruns (module globals don't), so a check still in flight from an interrupted rerun is reused.
+    # Returns (executor, in-flight futures keyed by (org secret, API version, user ID), lock guarding that dict).
+    return ThreadPoolExecutor(max_workers=4), {}, threading.Lock()
+
+@st.cache_resource
+def _get_http_client():
+    # One pooled HTTP/2 client for the whole app: Sensay calls share (and multiplex over) one TLS connection.
+    # Credentials are sent per request, so sharing it across sessions is safe.
+    return httpx.Client(
+        http2=True, follow_redirects=True,
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+        headers={"Content-Type": "application/json"}
+    )
+
+def _sensay_error(err):
+    # Shared by the sync and async request helpers: turns an exception into the error dict shown in the UI
+    if isinstance(err, httpx.HTTPStatusError):
+        error_content = {"error": f"HTTP error occurred: {err}", "status_code": err.response.status_code, "details": None}
+        try:
+            error_content["details"] = err.response.json()
+        except ValueError: # If response is not JSON
+            error_content["details"] = err.response.text
+        return error_content
+    if isinstance(err, httpx.RequestError): # Network errors, timeouts, etc.
+        return {"error": f"Request error occurred: {err}"}
+    return {"error": f"An unexpected error occurred: {err}"}
+
+def make_sensay_request(method, endpoint, sensay_org_secret, sensay_api_version, json_data=None, params=None, user_id=None, client=None):
+    if method not in SENSAY_HTTP_METHODS:
+        return None, {"error": "Unsupported HTTP method"}
+
     headers = {
         "X-ORGANIZATION-SECRET": sensay_org_secret,
         "X-API-Version": sensay_api_version,
-        "Content-Type": "application/json"
     }
     if user_id:
         headers["X-USER-ID"] = user_id
 
     url = f"{SENSAY_API_BASE_URL}{endpoint}"
     try:
-        if method.upper() == "GET":
-            response = requests.get(url, headers=headers, params=params, timeout=30)
-        elif method.upper() == "POST":
-            response = requests.post(url, headers=headers, json=json_data, timeout=30)
-        elif method.upper() == "PUT":
-            response = requests.put(url, headers=headers, json=json_data, timeout=30)
-        elif method.upper() == "DELETE":
-            response = requests.delete(url, headers=headers, timeout=30)
-        else:
-            return None, {"error": "Unsupported HTTP method"}
+        # Bodies are pre-encoded with orjson; the client already sends Content-Type: application/json
+        body = orjson.dumps(json_data) if json_data is not None else None
+        response = (client or _get_http_client()).request(method, url, headers=headers, content=body, params=params, timeout=30)
         
-        response.raise_for_status() # Will raise an HTTPError for bad responses (4XX or 5XX)
+        response.raise_for_status() # Will raise an HTTPStatusError for bad responses (4XX or 5XX)
         return response.json(), None
-    except requests.exceptions.HTTPError as http_err:
-        error_content = {"error": f"HTTP error occurred: {http_err}", "status_code": http_err.response.status_code, "details": None}
+    except Exception as err:
+        return None, _sensay_error(err)
+
+def _verify_sensay_user(user_id, sensay_org_secret, sensay_api_version, client):
+    # Looks the user up and creates it on 404; returns (created, error). Runs on the user-check pool.
+    _, user_error = make_sensay_request(
+        "GET", f"/users/{user_id}",
+        sensay_org_secret, sensay_api_version, client=client
+    )
+    if user_error and user_error.get("status_code") == 404: # User not found
+        create_user_payload = {"id": user_id}
+        _, user_error = make_sensay_request(
+            "POST", "/users",
+            sensay_org_secret, sensay_api_version,
+            json_data=create_user_payload, client=client
+        )
+        return not user_error, user_error
+    return False, user_error
+
+def _ensure_sensay_user(user_id, sensay_org_secret, sensay_api_version):
+    # Returns (created, error); users already confirmed this session are not looked up again,
+    # and concurrent callers for the same user (from any session) share a single in-flight check
+    check_key = (sensay_org_secret, sensay_api_version, user_id) # Credentials can change in the sidebar without a Save
+    if check_key in st.session_state.verified_sensay_users:
+        return False, None
+    executor, inflight, lock = _user_check_pool()
+    with lock:
+        future = inflight.get(check_key)
+        submitted = future is None
+        if submitted:
+            future = executor.submit(_verify_sensay_user, user_id, sensay_org_secret, sensay_api_version, _get_http_client())
+            inflight[check_key] = future
+    if submitted:
+        # Forget the check once it finishes, even if nobody is waiting on it any more
+        def _forget_check(done_future):
+            with lock:
+                if inflight.get(check_key) is done_future:
+                    del inflight[check_key]
+        future.add_done_callback(_forget_check)
+    try:
+        created, user_error = future.result(timeout=SENSAY_USER_CHECK_TIMEOUT)
+    except FutureTimeoutError: # Left in flight, so the next rerun joins it instead of sending another GET
+        return False, {"error": f"Timed out after {SENSAY_USER_CHECK_TIMEOUT}s waiting for Sensay user check"}
+    created = created and submitted # Only the caller that triggered the creation reports it
+    if not user_error:
+        st.session_state.verified_sensay_users.add(check_key)
+    return created, user_error
+
+async def make_sensay_request_async(client, method, endpoint, sensay_org_secret, sensay_api_version, json_data=None):
+    # Async counterpart of make_sensay_request for the training pipeline; same (data, error) contract
+    headers = {
+        "X-ORGANIZATION-SECRET": sensay_org_secret,
+        "X-API-Version": sensay_api_version,
+    }
+    url = f"{SENSAY_API_BASE_URL}{endpoint}"
+    try:
+        body = orjson.dumps(json_data) if json_data is not None else None
+        response = await client.request(method, url, headers=headers, content=body, timeout=30)
+        response.raise_for_status()
+        return response.json(), None
+    except Exception as err:
+        return None, _sensay_error(err)
+
+async def _train_message(client, create_slots, upload_slots, msg_data, replica_uuid, sensay_org_secret, sensay_api_version):
+    # Returns (msg_data, trained_ok, log_line). The POST and the PUT are capped by separate semaphores,
+    # so later POSTs overlap earlier PUTs.
+    message_content = msg_data.get("message_content")
+    message_ts = msg_data.get("slack_message_ts")
+    supabase_msg_id = msg_data.get("id")
+
+    async with create_slots:
+        kb_entry_data, kb_entry_error = await make_sensay_request_async(
+            client, "POST", f"/replicas/{replica_uuid}/training",
+            sensay_org_secret, sensay_api_version,
+            json_data={}
+        )
+
+    if kb_entry_error or not kb_entry_data or not kb_entry_data.get("success"):
+        return msg_data, False, f"❌ Failed to create Sensay KB entry for msg_ts {message_ts}: {kb_entry_error or kb_entry_data}"
+
+    knowledge_base_id = kb_entry_data.get("knowledgeBaseID")
+    if not knowledge_base_id:
+        return msg_data, False, f"❌ Missing knowledgeBaseID for msg_ts {message_ts} after KB entry creation."
+
+    update_kb_payload = {"rawText": message_content}
+    async with upload_slots:
+        update_kb_data, update_kb_error = await make_sensay_request_async(
+            client, "PUT", f"/replicas/{replica_uuid}/training/{knowledge_base_id}",
+            sensay_org_secret, sensay_api_version,
+            json_data=update_kb_payload
+        )
+
+    if update_kb_error or not update_kb_data or not update_kb_data.get("success"):
+        return msg_data, False, f"❌ Failed to add text to Sensay KB entry {knowledge_base_id} (msg_ts {message_ts}): {update_kb_error or update_kb_data}"
+    return msg_data, True, f"✅ Trained with Supabase Msg ID {supabase_msg_id} (KB ID: {knowledge_base_id})"
+
+async def _train_messages(message_pages, replica_uuid, sensay_org_secret, sensay_api_version):
+    # Trains every message over one pooled AsyncClient, yielding results as they complete.
+    # The client lives for a single run because it is bound to the event loop that drives it.
+    # At most 2 * TRAINING_CONCURRENCY messages are started but not yet yielded, which bounds the work
+    # lost (trained but never marked processed) if the run is interrupted.
+    limits = httpx.Limits(max_connections=2 * TRAINING_CONCURRENCY, max_keepalive_connections=2 * TRAINING_CONCURRENCY)
+    async with httpx.AsyncClient(http2=True, follow_redirects=True, limits=limits, headers={"Content-Type": "application/json"}) as client:
+        create_slots = asyncio.Semaphore(TRAINING_CONCURRENCY)
+        upload_slots = asyncio.Semaphore(TRAINING_CONCURRENCY)
+        pending = set()
+        fetch_error = None
+        pages = message_pages.__aiter__()
         try:
-            error_content["details"] = http_err.response.json()
-        except ValueError: # If response is not JSON
-            error_content["details"] = http_err.response.text
-        return None, error_content
-    except requests.exceptions.RequestException as req_err: # Catches network errors, timeouts, etc.
-        return None, {"error": f"Request error occurred: {req_err}"}
-    except Exception as err: # Catch-all for other unexpected errors
-        return None, {"error": f"An unexpected error occurred: {err}"}
+            while True:
+                try:
+                    messages_page = await pages.__anext__()
+                except StopAsyncIteration:
+                    break
+                except Exception as err:
+                    # A later page failed to load: still finish and report the messages already started
+                    fetch_error = err
+                    break
+                for msg_data in messages_page:
+                    if len(pending) >= 2 * TRAINING_CONCURRENCY:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            yield task.result()
+                    pending.add(asyncio.ensure_future(
+                        _train_message(client, create_slots, upload_slots, msg_data, replica_uuid, sensay_org_secret, sensay_api_version)
+                    ))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+            if fetch_error is not None:
+                raise fetch_error
+        finally:
+            # Closed early (e.g. Streamlit stopped the script): cancel in-flight requests before the client closes
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+def _iter_async(async_iterable):
+    # Drives an async iterator from synchronous Streamlit code on a private event loop
+    loop = asyncio.new_event_loop()
+    iterator = async_iterable.__aiter__()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(iterator.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(iterator.aclose()) # Runs the iterator's cleanup, e.g. cancelling its tasks
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+def _fetch_unprocessed_page(supabase_client, table_name, slack_user_id, after=None, count=None):
+    # Select specific columns to be more efficient; fetch in chronological order.
+    # Keyset pagination: `after` is the last row of the previous page, so rows marked processed
+    # mid-run (which drop out of the filter) can't shift later pages the way offsets would.
+    query = supabase_client.table(table_name)\
+        .select("message_content, slack_message_ts, id, created_at", count=count)\
+        .eq("slack_user_id", slack_user_id)\
+        .eq("processed_for_sensay", False)
+    if after is not None:
+        last_created_at, last_id = after["created_at"], after["id"]
+        query = query.or_(f'created_at.gt."{last_created_at}",and(created_at.eq."{last_created_at}",id.gt.{last_id})')
+    return query\
+        .order("created_at", desc=False)\
+        .order("id", desc=False)\
+        .limit(SUPABASE_PAGE_SIZE)\
+        .execute()
+
+class SupabasePageError(Exception):
+    # Raised by _iter_message_pages when a later page of messages can't be fetched
+    pass
+
+async def _iter_message_pages(fetch_page, first_page):
+    # Yields pages of messages while the next page is fetched on a worker thread, awaited so the
+    # event loop keeps driving in-flight training requests meanwhile.
+    # Stops on an empty page rather than a short one, since PostgREST's max_rows may cap pages below SUPABASE_PAGE_SIZE.
+    loop = asyncio.get_event_loop()
+    page = first_page
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        while page:
+            next_page = loop.run_in_executor(prefetcher, fetch_page, page[-1])
+            yield page
+            try:
+                page = (await next_page).data
+            except Exception as err:
+                raise SupabasePageError(err) from err
+
+def _mark_messages_processed(supabase_client, table_name, message_ids):
+    # One UPDATE per batch of IDs; if a batch fails, retry it row by row so one bad row doesn't fail the rest.
+    # return=minimal: PostgREST answers 204 instead of sending the updated rows back.
+    failed = []
+    for start in range(0, len(message_ids), SUPABASE_UPDATE_BATCH_SIZE):
+        batch_ids = message_ids[start:start + SUPABASE_UPDATE_BATCH_SIZE]
+        try:
+            supabase_client.table(table_name)\
+                .update({"processed_for_sensay": True}, returning=ReturnMethod.minimal)\
+                .in_("id", batch_ids)\
+                .execute()
+        except Exception:
+            for msg_id in batch_ids:
+                try:
+                    supabase_client.table(table_name)\
+                        .update({"processed_for_sensay": True}, returning=ReturnMethod.minimal)\
+                        .eq("id", msg_id)\
+                        .execute() # Use primary key for update
+                except Exception as e_supa_update:
+                    failed.append((msg_id, e_supa_update))
+    return failed
+
+def _replica_json(replica):
+    # Pretty-printed the first time a replica's JSON is shown, then reused until the list is refreshed
+    if replica.uuid not in st.session_state.replicas_json:
+        st.session_state.replicas_json[replica.uuid] = orjson.dumps(replica.raw, option=orjson.OPT_INDENT_2).decode()
+    return st.session_state.replicas_json[replica.uuid]
 
 # --- Streamlit App ---
 
@@ -80,10 +354,18 @@ if 'config_set' not in st.session_state:
     st.session_state.config_set = False
 if 'replicas_list' not in st.session_state:
     st.session_state.replicas_list = []
+if 'uuid_to_replica' not in st.session_state: # Replica UUID -> replica, in list order
+    st.session_state.uuid_to_replica = {}
+if 'replica_labels' not in st.session_state: # Replica UUID -> "Name (UUID)" selectbox label
+    st.session_state.replica_labels = {}
+if 'replicas_json' not in st.session_state: # Pretty-printed JSON per replica UUID
+    st.session_state.replicas_json = {}
 if 'chat_histories' not in st.session_state: # For the chat tab
     st.session_state.chat_histories = {}
 if 'selected_replica_for_chat_uuid' not in st.session_state:
     st.session_state.selected_replica_for_chat_uuid = None
+if 'verified_sensay_users' not in st.session_state: # (org secret, API version, user ID) known to exist in Sensay
+    st.session_state.verified_sensay_users = set()
 
 
 # --- Configuration Sidebar ---
@@ -108,7 +390,7 @@ with st.sidebar:
             st.session_state.supabase_url and st.session_state.supabase_service_key and 
             st.session_state.supabase_table_name and st.session_state.test_chat_user_id):
             try:
-                st.session_state.supabase_client = create_client(st.session_state.supabase_url, st.session_state.supabase_service_key)
+                st.session_state.supabase_client = _supabase(st.session_state.supabase_url, st.session_state.supabase_service_key)
                 # Test Supabase connection (optional but good)
                 st.session_state.supabase_client.table(st.session_state.supabase_table_name).select("id", head=True).limit(1).execute()
                 st.session_state.config_set = True
@@ -124,6 +406,11 @@ if not st.session_state.config_set:
     st.error("🚨 Please configure API settings in the sidebar and click 'Save Configuration & Initialize'.")
     st.stop()
 
+# Snapshot the Sensay credentials once per rerun rather than re-reading session state for every API call
+sensay_org_secret = st.session_state.sensay_org_secret
+sensay_api_version = st.session_state.sensay_api_version
+sensay_request = functools.partial(make_sensay_request, sensay_org_secret=sensay_org_secret, sensay_api_version=sensay_api_version)
+
 # --- Main Application Tabs ---
 
 tab1, tab2, tab3 = st.tabs(["🚀 Create & Manage Replicas", "📚 Train Replicas", "💬 Test Replica"])
@@ -151,66 +438,56 @@ with tab1:
         else:
             with st.spinner("Verifying/Creating Sensay user and then replica..."):
                 sensay_user_id = slack_user_id_for_replica
-                user_data, user_error = make_sensay_request(
-                    "GET", f"/users/{sensay_user_id}",
-                    st.session_state.sensay_org_secret, st.session_state.sensay_api_version
+                user_created, user_error = _ensure_sensay_user(
+                    sensay_user_id,
+                    sensay_org_secret, sensay_api_version
                 )
-                if user_error and user_error.get("status_code") == 404: # User not found
-                    st.write(f"Sensay user '{sensay_user_id}' not found, attempting to create...")
-                    create_user_payload = {"id": sensay_user_id}
-                    user_data, user_error = make_sensay_request(
-                        "POST", "/users",
-                        st.session_state.sensay_org_secret, st.session_state.sensay_api_version,
-                        json_data=create_user_payload
-                    )
 
                 if user_error:
                     st.error(f"Error managing Sensay user '{sensay_user_id}': {user_error.get('details', user_error)}")
                 else:
-                    st.success(f"Sensay User '{sensay_user_id}' confirmed/created: {user_data.get('id')}")
-                    
                     replica_payload = {
                         "name": replica_name, "shortDescription": replica_short_description,
                         "greeting": replica_greeting, "ownerID": sensay_user_id,
                         "private": False, "slug": replica_slug,
                         "llm": {"provider": llm_provider, "model": llm_model}
                     }
-                    replica_data, replica_error = make_sensay_request(
+                    replica_data, replica_error = sensay_request(
                         "POST", "/replicas",
-                        st.session_state.sensay_org_secret, st.session_state.sensay_api_version,
                         json_data=replica_payload
                     )
                     if replica_error:
                         st.error(f"Failed to create replica: {replica_error.get('details', replica_error)}")
                     elif replica_data and replica_data.get("success"):
-                        st.success(f"Replica '{replica_name}' created successfully! UUID: {replica_data.get('uuid')}")
-                        st.balloons()
+                        st.success(f"Replica '{replica_name}' created successfully! UUID: {replica_data.get('uuid')} (Sensay user '{sensay_user_id}' {'created' if user_created else 'confirmed'}).")
+                        if not st.session_state.get("balloons_shown"): # Celebrate the first creation only
+                            st.balloons()
+                            st.session_state.balloons_shown = True
                     else:
                         st.error(f"Replica creation response indicates failure or missing data: {replica_data}")
 
     st.divider()
     st.subheader("🗂️ Existing Replicas")
     
-    owner_id_filter = st.text_input("Filter by Owner ID (Slack User ID / Sensay User ID)", 
-                                    value=st.session_state.get("list_owner_filter_val", ""), 
-                                    key="list_owner_filter_input")
-    st.session_state.list_owner_filter_val = owner_id_filter # Persist filter value
+    with st.form("filter_form"): # Filter edits only rerun the script on submit
+        owner_id_filter = st.text_input("Filter by Owner ID (Slack User ID / Sensay User ID)", 
+                                        key="list_owner_filter_input")
+        submitted_refresh = st.form_submit_button("🔄 Refresh Replicas List", use_container_width=True)
 
-    if st.button("🔄 Refresh Replicas List", use_container_width=True):
+    if submitted_refresh:
         params = {}
         if owner_id_filter: params["ownerID"] = owner_id_filter
         
         with st.spinner("Fetching replicas from Sensay..."):
-            replicas_data, replicas_error = make_sensay_request(
+            replicas_data, replicas_error = sensay_request(
                 "GET", "/replicas",
-                st.session_state.sensay_org_secret, st.session_state.sensay_api_version,
                 params=params
             )
             if replicas_error:
                 st.error(f"Failed to fetch replicas: {replicas_error.get('details', replicas_error)}")
                 st.session_state.replicas_list = []
             elif replicas_data and replicas_data.get("success") and isinstance(replicas_data.get("items"), list):
-                st.session_state.replicas_list = replicas_data["items"]
+                st.session_state.replicas_list = [ReplicaView.from_api(r) for r in replicas_data["items"]]
                 st.success(f"Found {len(st.session_state.replicas_list)} replicas matching filter.")
                 if not st.session_state.replicas_list and owner_id_filter:
                     st.info("No replicas found for the specified Owner ID.")
@@ -219,13 +496,18 @@ with tab1:
             else:
                 st.warning(f"No replicas found or unexpected response: {replicas_data}")
                 st.session_state.replicas_list = []
+            st.session_state.replicas_json = {} # Drop JSON rendered for the previous list
+            # Index the list once per fetch so the selectors below don't rebuild it on every rerun
+            st.session_state.uuid_to_replica = {r.uuid: r for r in st.session_state.replicas_list}
+            st.session_state.replica_labels = {u: f"{r.name} ({u})" for u, r in st.session_state.uuid_to_replica.items()}
     
     if st.session_state.replicas_list:
         for replica in st.session_state.replicas_list:
-            with st.expander(f"👤 **{replica.get('name', 'N/A')}** (Slug: {replica.get('slug', 'N/A')}, UUID: `{replica.get('uuid', 'N/A')}`)", expanded=False):
-                st.caption(f"Owner ID: {replica.get('ownerID', replica.get('owner_uuid', 'N/A'))} | LLM: {replica.get('llm', {}).get('model', 'N/A')}")
-                st.code(json.dumps(replica, indent=2), language="json")
-    elif not st.session_state.get("list_owner_filter_val"): # only show if no filter is active or initial load
+            with st.expander(f"👤 **{replica.name}** (Slug: {replica.slug}, UUID: `{replica.uuid}`)", expanded=False):
+                st.caption(f"Owner ID: {replica.owner_id or replica.raw.get('owner_uuid', 'N/A')} | LLM: {replica.llm_model}")
+                if st.toggle("Show raw JSON", key=f"json_{replica.uuid}"):
+                    st.code(_replica_json(replica), language="json")
+    elif not owner_id_filter: # only show if no filter is active or initial load
         st.info("Click 'Refresh Replicas List' to load. You can filter by Owner ID.")
 
 with tab2:
@@ -234,42 +516,38 @@ with tab2:
     if not st.session_state.replicas_list:
         st.warning("💡 Load or refresh replicas in the '🚀 Create & Manage Replicas' tab first to select one for training.")
     else:
-        replica_options = {f"{r.get('name')} ({r.get('uuid')})": r for r in st.session_state.replicas_list}
-        selected_replica_display_name = st.selectbox("Select Replica to Train", options=[""] + list(replica_options.keys()), index=0, format_func=lambda x: "Select a Replica..." if x == "" else x)
+        replica_labels = st.session_state.replica_labels
+        replica_uuid_to_train = st.selectbox("Select Replica to Train", options=[""] + list(replica_labels), index=0, format_func=lambda x: "Select a Replica..." if x == "" else replica_labels[x])
 
-        if selected_replica_display_name:
-            selected_replica_obj = replica_options[selected_replica_display_name]
-            replica_uuid_to_train = selected_replica_obj.get("uuid")
-            slack_user_id_for_training = selected_replica_obj.get("ownerID") # Crucial for fetching messages
+        if replica_uuid_to_train:
+            selected_replica_obj = st.session_state.uuid_to_replica[replica_uuid_to_train]
+            slack_user_id_for_training = selected_replica_obj.owner_id # Crucial for fetching messages
 
-            st.markdown(f"#### Training: **{selected_replica_obj.get('name')}**")
+            st.markdown(f"#### Training: **{selected_replica_obj.name}**")
             st.caption(f"Replica UUID: `{replica_uuid_to_train}` | Training with messages from Slack User: `{slack_user_id_for_training}`")
 
-            if st.button(f"💪 Start Training/Retraining for {selected_replica_obj.get('name')}", key=f"train_btn_{replica_uuid_to_train}", use_container_width=True):
+            if st.button(f"💪 Start Training/Retraining for {selected_replica_obj.name}", key=f"train_btn_{replica_uuid_to_train}", use_container_width=True):
                 if not slack_user_id_for_training:
                     st.error("Cannot determine Slack User ID (ownerID) for this replica. Training aborted.")
                 else:
                     training_log_area = st.empty()
                     progress_bar = st.progress(0, text="Initializing training...")
                     
+                    fetch_page = functools.partial(
+                        _fetch_unprocessed_page,
+                        st.session_state.supabase_client, st.session_state.supabase_table_name, slack_user_id_for_training
+                    )
                     with st.spinner(f"Fetching unprocessed Slack messages for '{slack_user_id_for_training}' from Supabase..."):
                         try:
-                            # Select specific columns to be more efficient
-                            response = st.session_state.supabase_client.table(st.session_state.supabase_table_name)\
-                                .select("message_content, slack_message_ts, id")\
-                                .eq("slack_user_id", slack_user_id_for_training)\
-                                .eq("processed_for_sensay", False)\
-                                .order("created_at", desc=False)\
-                                .execute() # Fetch in chronological order
-                            
-                            messages_to_train = response.data
-                            if not messages_to_train:
+                            response = fetch_page(count="exact") # First page also reports the total for progress
+                            if not response.data:
                                 st.info(f"✅ No new messages found in Supabase for user '{slack_user_id_for_training}' to train with.")
                                 progress_bar.empty()
                                 training_log_area.empty()
                                 st.stop()
                             
-                            st.success(f"Found {len(messages_to_train)} new Slack messages to train with.")
+                            total_messages = response.count or len(response.data)
+                            progress_bar.progress(0.0, text=f"Found {total_messages} new Slack messages to train with...")
 
                         except Exception as e:
                             st.error(f"Error fetching messages from Supabase: {e}")
@@ -277,71 +555,66 @@ with tab2:
                             training_log_area.empty()
                             st.stop()
 
-                    total_messages = len(messages_to_train)
-                    processed_count = 0
+                    done_count = 0
                     error_count = 0
                     training_logs = []
-
-                    for i, msg_data in enumerate(messages_to_train):
-                        message_content = msg_data.get("message_content")
-                        message_ts = msg_data.get("slack_message_ts")
-                        supabase_msg_id = msg_data.get("id")
-
-                        progress_text = f"Processing message {i+1}/{total_messages}: '{message_content[:30].replace(chr(10), ' ')}...'"
-                        progress_bar.progress((i + 1) / total_messages, text=progress_text)
-                        
-                        kb_entry_data, kb_entry_error = make_sensay_request(
-                            "POST", f"/replicas/{replica_uuid_to_train}/training",
-                            st.session_state.sensay_org_secret, st.session_state.sensay_api_version,
-                            json_data={}
-                        )
-
-                        if kb_entry_error or not kb_entry_data or not kb_entry_data.get("success"):
-                            log_line = f"❌ Failed to create Sensay KB entry for msg_ts {message_ts}: {kb_entry_error or kb_entry_data}"
-                            training_logs.append(log_line)
-                            error_count += 1
-                            continue
-                        
-                        knowledge_base_id = kb_entry_data.get("knowledgeBaseID")
-                        if not knowledge_base_id:
-                            log_line = f"❌ Missing knowledgeBaseID for msg_ts {message_ts} after KB entry creation."
-                            training_logs.append(log_line)
-                            error_count +=1
-                            continue
-
-                        update_kb_payload = {"rawText": message_content}
-                        update_kb_data, update_kb_error = make_sensay_request(
-                            "PUT", f"/replicas/{replica_uuid_to_train}/training/{knowledge_base_id}",
-                            st.session_state.sensay_org_secret, st.session_state.sensay_api_version,
-                            json_data=update_kb_payload
-                        )
-
-                        if update_kb_error or not update_kb_data or not update_kb_data.get("success"):
-                            log_line = f"❌ Failed to add text to Sensay KB entry {knowledge_base_id} (msg_ts {message_ts}): {update_kb_error or update_kb_data}"
-                            training_logs.append(log_line)
-                            error_count += 1
-                        else:
-                            try:
-                                st.session_state.supabase_client.table(st.session_state.supabase_table_name)\
-                                    .update({"processed_for_sensay": True})\
-                                    .eq("id", supabase_msg_id)\
-                                    .execute() # Use primary key for update
-                                processed_count += 1
-                                log_line = f"✅ Trained with Supabase Msg ID {supabase_msg_id} (KB ID: {knowledge_base_id})"
-                                training_logs.append(log_line)
-                            except Exception as e_supa_update:
-                                log_line = f"⚠️ Trained Sensay with msg_ts {message_ts}, but FAILED to update Supabase: {e_supa_update}"
+                    recent_logs = collections.deque(maxlen=TRAINING_LOG_TAIL_LINES)
+                    trained_count = 0
+                    unmarked_msg_ids = [] # Trained in Sensay, not yet marked processed in Supabase
+                    failed_updates = []
+                    log_flush_count = 0
+                    last_log_flush = time.monotonic()
+
+                    training_results = _iter_async(_train_messages(
+                        _iter_message_pages(fetch_page, response.data), replica_uuid_to_train,
+                        sensay_org_secret, sensay_api_version
+                    ))
+                    try:
+                        try:
+                            for msg_data, trained_ok, log_line in training_results:
+                                message_content = msg_data.get("message_content")
                                 training_logs.append(log_line)
-                                error_count += 1
-                        
-                        training_log_area.text_area("Training Log", value="\n".join(training_logs[-10:]), height=200, key=f"training_log_display_{replica_uuid_to_train}", disabled=True) # Show last 10 logs
-                        time.sleep(0.2) # API politeness delay
+                                recent_logs.append(log_line)
+                                if trained_ok:
+                                    trained_count += 1
+                                    unmarked_msg_ids.append(msg_data.get("id"))
+                                    if len(unmarked_msg_ids) >= SUPABASE_UPDATE_BATCH_SIZE:
+                                        failed_updates.extend(_mark_messages_processed(st.session_state.supabase_client, st.session_state.supabase_table_name, unmarked_msg_ids))
+                                        unmarked_msg_ids = []
+                                else:
+                                    error_count += 1
+                                done_count += 1
+
+                                progress_text = f"Processed message {done_count}/{total_messages}: '{message_content[:30].replace(chr(10), ' ')}...'"
+                                progress_bar.progress(min(done_count / total_messages, 1.0), text=progress_text)
+                                # Redrawing the log on every message floods the websocket, so batch the redraws
+                                if done_count % TRAINING_LOG_FLUSH_EVERY == 0 or time.monotonic() - last_log_flush > TRAINING_LOG_FLUSH_SECONDS:
+                                    log_flush_count += 1
+                                    training_log_area.text_area("Training Log", value="\n".join(recent_logs), height=200, key=f"training_log_display_{replica_uuid_to_train}_{log_flush_count}", disabled=True)
+                                    last_log_flush = time.monotonic()
+                        except SupabasePageError as e:
+                            training_logs.append(f"❌ Error fetching further messages from Supabase: {e}")
+                            error_count += 1
+                    finally:
+                        training_results.close() # Cancel any Sensay requests still in flight
+                        # Also runs when Streamlit stops the script mid-run (its Stop/Rerun exceptions are BaseExceptions),
+                        # so messages already trained in Sensay are still marked and not trained again next time
+                        failed_updates.extend(_mark_messages_processed(st.session_state.supabase_client, st.session_state.supabase_table_name, unmarked_msg_ids))
+                        unmarked_msg_ids = []
+
+                    for supabase_msg_id, e_supa_update in failed_updates:
+                        training_logs.append(f"⚠️ Trained Sensay with Supabase Msg ID {supabase_msg_id}, but FAILED to update Supabase: {e_supa_update}")
+                    processed_count = trained_count - len(failed_updates)
+                    error_count += len(failed_updates)
 
                     progress_bar.empty()
                     training_log_area.text_area("Full Training Log", value="\n".join(training_logs), height=300, key=f"final_training_log_{replica_uuid_to_train}", disabled=True)
-                    st.success(f"Training complete for '{selected_replica_obj.get('name')}'. Successfully trained: {processed_count}, Errors: {error_count}.")
+                    # One summary card for the whole run
+                    training_summary = f"Training complete for '{selected_replica_obj.name}'. Successfully trained: {processed_count}, Errors: {error_count}."
                     if error_count > 0:
-                        st.error("Some messages could not be processed. Check logs for details.")
+                        st.warning(f"{training_summary} Some messages could not be processed. Check logs for details.")
+                    else:
+                        st.success(training_summary)
 
 with tab3:
     st.subheader("💬 Test Replica (Interactive Chat)")
@@ -349,7 +622,8 @@ with tab3:
     if not st.session_state.replicas_list:
         st.warning("💡 Load or refresh replicas in the '🚀 Create & Manage Replicas' tab first to select one for testing.")
     else:
-        replica_options_chat = {f"{r.get('name')} ({r.get('uuid')})": r for r in st.session_state.replicas_list}
+        uuid_to_replica = st.session_state.uuid_to_replica
+        replica_labels = st.session_state.replica_labels
         
         # Use a selectbox that updates session state for the selected replica's UUID
         # This helps persist the selection across reruns if the user navigates away and back
@@ -357,32 +631,31 @@ with tab3:
         # Get current index for selectbox default
         current_selection_idx = 0
         if st.session_state.selected_replica_for_chat_uuid:
-            try:
-                current_selection_idx = [r.get('uuid') for r in st.session_state.replicas_list].index(st.session_state.selected_replica_for_chat_uuid) +1 # +1 because of the "Select..." option
-            except ValueError:
+            if st.session_state.selected_replica_for_chat_uuid in uuid_to_replica:
+                current_selection_idx = list(uuid_to_replica).index(st.session_state.selected_replica_for_chat_uuid) +1 # +1 because of the "Select..." option
+            else:
                 st.session_state.selected_replica_for_chat_uuid = None # Reset if not found
 
-        selected_replica_display_name_chat = st.selectbox(
+        replica_uuid_to_test = st.selectbox(
             "Select Replica to Chat With", 
-            options=[""] + list(replica_options_chat.keys()), 
+            options=[""] + list(replica_labels), 
             index=current_selection_idx,
-            format_func=lambda x: "Select a Replica..." if x == "" else x,
+            format_func=lambda x: "Select a Replica..." if x == "" else replica_labels[x],
             key="chat_replica_selector"
         )
 
-        if selected_replica_display_name_chat:
-            selected_replica_obj_chat = replica_options_chat[selected_replica_display_name_chat]
-            replica_uuid_to_test = selected_replica_obj_chat.get("uuid")
+        if replica_uuid_to_test:
+            selected_replica_obj_chat = uuid_to_replica[replica_uuid_to_test]
             st.session_state.selected_replica_for_chat_uuid = replica_uuid_to_test # Persist selection
 
-            st.markdown(f"#### Chatting with: **{selected_replica_obj_chat.get('name')}**")
+            st.markdown(f"#### Chatting with: **{selected_replica_obj_chat.name}**")
             st.caption(f"Replica UUID: `{replica_uuid_to_test}` | Test User ID: `{st.session_state.test_chat_user_id}`")
 
             # Initialize chat history for this replica if it doesn't exist
             if replica_uuid_to_test not in st.session_state.chat_histories:
-                st.session_state.chat_histories[replica_uuid_to_test] = []
+                st.session_state.chat_histories[replica_uuid_to_test] = collections.deque(maxlen=CHAT_HISTORY_MAX_MESSAGES)
                 # Prepend greeting if it exists and chat is new
-                greeting = selected_replica_obj_chat.get("greeting")
+                greeting = selected_replica_obj_chat.greeting
                 if greeting:
                     st.session_state.chat_histories[replica_uuid_to_test].append({"role": "assistant", "content": greeting})
             
@@ -392,7 +665,7 @@ with tab3:
                     st.markdown(message["content"])
 
             # Chat input
-            if prompt := st.chat_input(f"Ask {selected_replica_obj_chat.get('name', 'replica')}..."):
+            if prompt := st.chat_input(f"Ask {selected_replica_obj_chat.name}..."):
                 # Add user message to session state and display
                 st.session_state.chat_histories[replica_uuid_to_test].append({"role": "user", "content": prompt})
                 with st.chat_message("user"):
@@ -401,19 +674,13 @@ with tab3:
                 with st.spinner("🤖 Thinking..."):
                     # Ensure test user exists in Sensay
                     test_user_id = st.session_state.test_chat_user_id
-                    user_data, user_error = make_sensay_request(
-                        "GET", f"/users/{test_user_id}",
-                        st.session_state.sensay_org_secret, st.session_state.sensay_api_version
+                    user_created, user_error = _ensure_sensay_user(
+                        test_user_id,
+                        sensay_org_secret, sensay_api_version
                     )
-                    if user_error and user_error.get("status_code") == 404: # User not found
+                    if user_created:
                         with st.chat_message("assistant"):
-                            st.info(f"Test user '{test_user_id}' not found in Sensay. Attempting to create...")
-                        create_user_payload = {"id": test_user_id}
-                        user_data, user_error = make_sensay_request(
-                            "POST", "/users",
-                            st.session_state.sensay_org_secret, st.session_state.sensay_api_version,
-                            json_data=create_user_payload
-                        )
+                            st.info(f"Test user '{test_user_id}' was not found in Sensay and has been created.")
                     
                     if user_error:
                         err_msg_user = f"Error with test user '{test_user_id}': {user_error.get('details', user_error)}"
@@ -422,9 +689,8 @@ with tab3:
                             st.error(err_msg_user)
                     else: # User confirmed or created, proceed with chat
                         chat_payload = {"content": prompt}
-                        response_data, response_error = make_sensay_request(
+                        response_data, response_error = sensay_request(
                             "POST", f"/replicas/{replica_uuid_to_test}/chat/completions",
-                            st.session_state.sensay_org_secret, st.session_state.sensay_api_version,
                             json_data=chat_payload, user_id=test_user_id
                         )
 